@@ -1,71 +1,172 @@
 #!/usr/bin/env python3
 """
-Convert Sigma rules to Splunk SPL queries using sigma-cli.
+Convert Sigma rules to Splunk SPL queries using pySigma.
 """
+import contextlib
+import functools
+import hashlib
+import io
 import json
-import subprocess
+import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib.metadata import version
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import yaml
+from sigma.backends.splunk import SplunkBackend
+from sigma.processing.pipeline import ProcessingItem, ProcessingPipeline
+from sigma.processing.transformations import AddConditionTransformation
+from sigma.rule import SigmaRule
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 SIGMA_RULES_DIR = Path(__file__).parent / "sigma_rules"
+CACHE_DIR = Path(__file__).parent / ".sigma_cache"
 
+# A pySigma conversion takes well under a millisecond, so only fork worker processes for large batches
+PARALLEL_MIN_RULES = 100
 
-def install_splunk_backend():
-    """Install the Splunk backend for sigma-cli."""
-    print("Installing pySigma Splunk backend...")
-    try:
-        subprocess.run(
-            ["sigma", "plugin", "install", "splunk"],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        print("Splunk backend installed successfully")
-    except subprocess.CalledProcessError as e:
-        print(f"Warning: Could not install Splunk backend: {e.stderr}")
-        print("Continuing anyway - backend may already be installed")
+# Prefer the libyaml-backed loader when PyYAML was built with it
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Identifies the code that produced a cached query, so changes to this script or to pySigma invalidate the cache
+CONVERTER_FINGERPRINT = hashlib.blake2b(
+    b"\0".join([
+        Path(__file__).read_bytes(),
+        version("pySigma").encode(),
+        version("pySigma-backend-splunk").encode(),
+    ]),
+    digest_size=8,
+).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_splunk_backend(product: Optional[str], service: Optional[str]) -> SplunkBackend:
+    """
+    Get a Splunk backend for a log source, reused across all rules with the same product and service.
+    Its processing pipeline scopes queries by source/sourcetype the same way the fallback converter does.
+    """
+    if product and service:
+        conditions = {"source": product, "sourcetype": service}
+    elif product:
+        conditions = {"sourcetype": product}
+    else:
+        conditions = {}
+
+    items = []
+    if conditions:
+        items.append(ProcessingItem(
+            identifier="splunk_logsource",
+            transformation=AddConditionTransformation(conditions=conditions),
+        ))
+
+    return SplunkBackend(processing_pipeline=ProcessingPipeline(name="Splunk log source mapping", items=items))
 
 
 def convert_sigma_rule(rule_path: Path) -> str:
-    """Convert a Sigma rule to Splunk SPL query format using sigma-cli."""
+    """Convert a Sigma rule to Splunk SPL query format using pySigma."""
     print(f"Converting {rule_path.name}...")
 
+    # Parse the rule once and share it between pySigma and the fallback converter
+    with open(rule_path, 'rb') as f:
+        rule_data = yaml.load(f, Loader=Loader) or {}
+
     try:
-        # Use sigma-cli to convert to Splunk format
-        result = subprocess.run(
-            ["sigma", "convert", "-t", "splunk", "-f", "default", str(rule_path)],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-
-        splunk_query = result.stdout.strip()
-
-        if not splunk_query:
-            # Fallback: create basic query from detection logic
-            print(f"  Using fallback converter for {rule_path.name}")
-            splunk_query = create_basic_splunk_query(rule_path)
-
-        print(f"Successfully converted {rule_path.name}")
-        return splunk_query
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error converting {rule_path.name}: {e.stderr}")
+        logsource = rule_data.get('logsource', {})
+        backend = get_splunk_backend(logsource.get('product'), logsource.get('service'))
+        rule = SigmaRule.from_dict(rule_data)
+        queries = backend.convert_rule(rule)
+    except Exception as e:
+        # pySigma raises more than SigmaError on malformed rules (e.g. TypeError, AttributeError)
+        print(f"Error converting {rule_path.name}: {e}")
         print(f"  Using fallback converter")
-        return create_basic_splunk_query(rule_path)
+        return create_basic_splunk_query(rule_data)
+
+    splunk_query = queries[0].strip() if queries else ''
+
+    if not splunk_query:
+        # Fallback: create basic query from detection logic
+        print(f"  Using fallback converter for {rule_path.name}")
+        splunk_query = create_basic_splunk_query(rule_data)
+
+    print(f"Successfully converted {rule_path.name}")
+    return splunk_query
+
+
+def dump_json(data: Dict) -> bytes:
+    """Serialize data to indented JSON, using orjson's C encoder when it's available."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode('utf-8')
+
+
+def get_cache_file(rule_path: Path, backend: str = "splunk") -> Path:
+    """Get the cache file for a rule, keyed on the backend, the converter version and a hash of the rule contents."""
+    rule_hash = hashlib.blake2b(rule_path.read_bytes()).hexdigest()
+    return CACHE_DIR / f"{backend}-{CONVERTER_FINGERPRINT}-{rule_hash}.json"
+
+
+def load_cached_query(cache_file: Path) -> Optional[str]:
+    """Load a previously converted query for an unchanged rule, if one exists."""
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)["query"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cached_query(cache_file: Path, rule_path: Path, query: str):
+    """Save a converted query to the cache, replacing the file atomically so concurrent writers are safe."""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dump_json({"file": rule_path.name, "query": query}))
+        os.replace(tmp_path, cache_file)
+    except OSError as e:
+        print(f"Warning: Could not cache query for {rule_path.name}: {e}")
+        Path(tmp_path).unlink(missing_ok=True)
 
 
-def create_basic_splunk_query(rule_path: Path) -> str:
+def convert_and_cache(rule_path: Path, cache_file: Path) -> Tuple[str, str]:
     """
-    Create a basic Splunk SPL query from Sigma rule detection logic.
-    This is a fallback when sigma-cli conversion doesn't work.
+    Convert a Sigma rule that missed the cache and save the query for later runs.
+    Returns the query and the conversion log, so the caller prints each rule's log in one piece.
     """
-    with open(rule_path, 'r', encoding='utf-8') as f:
-        rule_data = yaml.safe_load(f)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        query = convert_sigma_rule(rule_path)
+        save_cached_query(cache_file, rule_path, query)
+    return query, log.getvalue()
+
+
+def prune_cache(cache_files: List[Path]):
+    """Remove cached queries for edited or deleted rules, older converter versions and interrupted writes."""
+    keep = {cache_file.name for cache_file in cache_files}
+    if not CACHE_DIR.is_dir():
+        return
+
+    for cache_file in CACHE_DIR.iterdir():
+        if cache_file.name not in keep:
+            try:
+                cache_file.unlink()
+            except OSError as e:
+                print(f"Warning: Could not remove stale cache file {cache_file.name}: {e}")
+
 
+def create_basic_splunk_query(rule_data: Dict) -> str:
+    """
+    Create a basic Splunk SPL query from Sigma rule detection logic.
+    This is a fallback when pySigma conversion doesn't work.
+    """
     logsource = rule_data.get('logsource', {})
     detection = rule_data.get('detection', {})
 
@@ -103,16 +204,23 @@ def create_basic_splunk_query(rule_path: Path) -> str:
         return 'search *'
 
 
+def list_sigma_files(rules_dir: Path) -> List[Path]:
+    """List the Sigma rule files in a directory with a single scan of its entries."""
+    sigma_files = []
+    with os.scandir(rules_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith((".yml", ".yaml")) and entry.is_file():
+                sigma_files.append(Path(entry.path))
+    return sorted(sigma_files)
+
+
 def main():
     """Main conversion process."""
-    print("Sigma to Splunk SPL Converter (using sigma-cli)")
+    print("Sigma to Splunk SPL Converter (using pySigma)")
     print("=" * 50)
 
-    # Install Splunk backend
-    install_splunk_backend()
-
     # Find all Sigma rules
-    sigma_files = list(SIGMA_RULES_DIR.glob("*.yml")) + list(SIGMA_RULES_DIR.glob("*.yaml"))
+    sigma_files = list_sigma_files(SIGMA_RULES_DIR)
 
     if not sigma_files:
         print(f"No Sigma rules found in {SIGMA_RULES_DIR}")
@@ -120,23 +228,58 @@ def main():
 
     print(f"\nFound {len(sigma_files)} Sigma rule(s)")
 
-    # Convert each rule
-    converted_rules = {}
+    # Reuse queries for rules that haven't changed since they were last converted
+    # Hash each rule once; the workers reuse the cache file path for rules that miss
+    cache_files = {rule_file: get_cache_file(rule_file) for rule_file in sigma_files}
+    queries = {}
     for rule_file in sigma_files:
-        try:
-            query = convert_sigma_rule(rule_file)
-            converted_rules[rule_file.stem] = {
-                "file": rule_file.name,
-                "query": query
+        query = load_cached_query(cache_files[rule_file])
+        if query is not None:
+            queries[rule_file] = query
+    if queries:
+        print(f"Using cached queries for {len(queries)} unchanged rule(s)")
+
+    remaining_files = [rule_file for rule_file in sigma_files if rule_file not in queries]
+    if len(remaining_files) >= PARALLEL_MIN_RULES:
+        # Convert large batches in parallel; logs are printed here so workers' output doesn't interleave
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {
+                executor.submit(convert_and_cache, rule_file, cache_files[rule_file]): rule_file
+                for rule_file in remaining_files
             }
-        except Exception as e:
-            print(f"Failed to convert {rule_file.name}: {e}")
-            sys.exit(1)
+            for future in as_completed(futures):
+                rule_file = futures[future]
+                try:
+                    queries[rule_file], log = future.result()
+                except Exception as e:
+                    print(f"Failed to convert {rule_file.name}: {e}")
+                    executor.shutdown(cancel_futures=True)
+                    sys.exit(1)
+                sys.stdout.write(log)
+    else:
+        for rule_file in remaining_files:
+            try:
+                queries[rule_file], log = convert_and_cache(rule_file, cache_files[rule_file])
+            except Exception as e:
+                print(f"Failed to convert {rule_file.name}: {e}")
+                sys.exit(1)
+            sys.stdout.write(log)
+
+    # Drop cache entries that no current rule uses so the CI cache doesn't grow between runs
+    prune_cache(list(cache_files.values()))
+
+    # Keep output in discovery order so converted_rules.json is stable between runs
+    converted_rules = {}
+    for rule_file in sigma_files:
+        converted_rules[rule_file.stem] = {
+            "file": rule_file.name,
+            "query": queries[rule_file]
+        }
 
     # Save converted rules to JSON
     output_file = Path(__file__).parent / "converted_rules.json"
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(converted_rules, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(dump_json(converted_rules))
 
     print(f"\nSuccessfully converted {len(converted_rules)} rule(s)")
     print(f"Output saved to: {output_file}")
@@ -145,10 +288,11 @@ def main():
     print("\n" + "=" * 50)
     print("Converted Queries")
     print("=" * 50)
-    for rule_name, data in converted_rules.items():
-        print(f"\n{rule_name}:")
-        print(f"  File: {data['file']}")
-        print(f"  Query:\n    {data['query']}")
+    # Build the report up front and write it once rather than issuing several prints per rule
+    sys.stdout.write("".join(
+        f"\n{rule_name}:\n  File: {data['file']}\n  Query:\n    {data['query']}\n"
+        for rule_name, data in converted_rules.items()
+    ))
 
 
 if __name__ == "__main__":